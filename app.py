@@ -1,269 +1,261 @@
 #!/usr/bin/env python3
 import os
 import re
-import json
-import fitz  # PyMuPDF
-import pdfplumber
-import pandas as pd
-import zipfile
-from flask import Flask, request, render_template, send_from_directory, redirect, url_for, flash
+import shutil
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from flask import Blueprint, Flask, current_app, request, render_template, send_from_directory, url_for, jsonify
+
+from parser import ZIP_COMPRESSION, run_parse_job, run_rq_parse_job
+
+try:
+    # Optional: parses multipart uploads incrementally instead of buffering them in Werkzeug.
+    from streaming_form_data import StreamingFormDataParser
+    from streaming_form_data.parser import ParseFailedException
+    from streaming_form_data.targets import BaseTarget
+
+    class UploadTarget(BaseTarget):
+        """Streams a form part to a file and records whether the part's closing boundary arrived."""
+
+        def __init__(self, path):
+            super().__init__()
+            self.path = path
+            self.file = None
+            self.complete = False
+
+        def on_start(self):
+            self.file = open(self.path, 'wb')
+
+        def on_data_received(self, chunk):
+            self.file.write(chunk)
+
+        def on_finish(self):
+            self.file.close()
+            self.complete = True
+
+        def discard(self):
+            if self.file is not None:
+                self.file.close()
+                os.remove(self.path)
+except ImportError:
+    StreamingFormDataParser = None
+
+try:
+    # Optional: with REDIS_URL set, parsing runs on `rq worker` processes instead of the web process.
+    from redis import Redis
+    from rq import Queue
+    from rq.exceptions import NoSuchJobError
+    from rq.job import Job
+except ImportError:
+    Queue = None
 
 # -------------------
 # Flask App Setup
 # -------------------
-app = Flask(__name__)
-app.secret_key = 'supersecretkey'  # Needed for flashing messages
 UPLOAD_FOLDER = "uploads"
 OUTPUT_FOLDER = "outputs"
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-os.makedirs(OUTPUT_FOLDER, exist_ok=True)
-
-# A set of common English "stop words" to filter out from tags.
-STOP_WORDS = {
-    'a', 'about', 'above', 'after', 'again', 'against', 'all', 'am', 'an', 'and', 'any', 'are', 'as', 'at',
-    'be', 'because', 'been', 'before', 'being', 'below', 'between', 'both', 'but', 'by', 'can', 'did', 'do',
-    'does', 'doing', 'down', 'during', 'each', 'few', 'for', 'from', 'further', 'had', 'has', 'have', 'having',
-    'he', 'her', 'here', 'hers', 'herself', 'him', 'himself', 'his', 'how', 'i', 'if', 'in', 'into', 'is', 'it',
-    'its', 'itself', 'just', 'me', 'more', 'most', 'my', 'myself', 'no', 'nor', 'not', 'now', 'of', 'off', 'on',
-    'once', 'only', 'or', 'other', 'our', 'ours', 'ourselves', 'out', 'over', 'own', 's', 'same', 'she', 'should',
-    'so', 'some', 'such', 't', 'than', 'that', 'the', 'their', 'theirs', 'them', 'themselves', 'then', 'there',
-
-    'these', 'they', 'this', 'those', 'through', 'to', 'too', 'under', 'until', 'up', 'very', 'was', 'we', 'were',
-    'what', 'when', 'where', 'which', 'while', 'who', 'whom', 'why', 'will', 'with', 'you', 'your', 'yours',
-    'yourself', 'yourselves'
-}
+# Shared by all jobs so identical uploads reuse one parse; each job's zip goes to OUTPUT_FOLDER/<job_id>/.
+PARSE_CACHE_FOLDER = os.path.join(OUTPUT_FOLDER, "cache")
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+bp = Blueprint('pdf_parser', __name__)
+
+def create_app():
+    """Application factory; `gunicorn 'app:create_app()'` and the module-level `app` are equivalent."""
+    app = Flask(__name__)
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+    app.register_blueprint(bp)
+    return app
 
 # -------------------
-# Core PDF Parsing Logic
+# Upload Handling
 # -------------------
-def parse_toc(pdf_path):
-    """Parses the Table of Contents from the PDF."""
-    toc_data = []
-    try:
-        with pdfplumber.open(pdf_path) as pdf:
-            max_pages = len(pdf.pages)
-            # Example Regex: ^(\d+(.\d+)*)(\s+)([^\n.]+)(.+)\s+(\d+)$
-            # Using a simpler, more robust regex for broader compatibility.
-            toc_regex = re.compile(r'^(\d+(?:\.\d+)*)\s+(.*?)\s+(?:\.|\s)*\s*(\d+)$')
-
-            for page in pdf.pages[:40]: # Search in the first 40 pages
-                text = page.extract_text(x_tolerance=2, y_tolerance=2)
-                if not text:
-                    continue
-                for line in text.split("\n"):
-                    match = toc_regex.match(line)
-                    if match:
-                        section_id, title, page_num = match.groups()
-                        page_num = int(page_num)
-                        if page_num > max_pages:
-                            continue
-                        toc_data.append({
-                            "section_id": section_id.strip(),
-                            "title": title.strip().rstrip('.'),
-                            "page": page_num,
-                            "level": section_id.count(".") + 1
-                        })
-    except Exception as e:
-        flash(f"Error parsing table of contents: {e}", "error")
-        return None
-    return toc_data
-
-def parse_sections(pdf_path, toc):
-    """Extracts content for each section defined in the TOC."""
-    sections = []
+def stream_multipart_upload():
+    """Streams the 'pdf_file' form part straight to a temporary file, bypassing Werkzeug's form parser.
+
+    Returns (client_filename, temp_path); client_filename is None when the part is missing. Raises
+    ParseFailedException for a malformed or truncated body, after removing the temporary file.
+    """
+    part_path = os.path.join(UPLOAD_FOLDER, f".{uuid.uuid4().hex}.part")
+    target = UploadTarget(part_path)
     try:
-        doc = fitz.open(pdf_path)
-        max_pages = len(doc)
-        for i, entry in enumerate(toc):
-            start_page = max(0, entry["page"] - 1)
-            
-            if i + 1 < len(toc):
-                end_page = min(max_pages, toc[i + 1]["page"] - 1)
-            else:
-                end_page = max_pages
-
-            if end_page <= start_page:
-                end_page = min(start_page + 1, max_pages)
-
-            text_parts = [doc[p].get_text("text") for p in range(start_page, end_page) if 0 <= p < max_pages]
-            content = "\n".join(text_parts).strip()
-            
-            section_entry = entry.copy()
-            section_entry["content"] = content
-            sections.append(section_entry)
-
-    except Exception as e:
-        flash(f"Error extracting sections: {e}", "error")
-        return None
-    return sections
+        form_parser = StreamingFormDataParser(headers={'Content-Type': request.content_type})
+        form_parser.register('pdf_file', target)
+        while True:
+            chunk = request.stream.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            form_parser.data_received(chunk)
+        if target.file is not None and not target.complete:
+            raise ParseFailedException("Upload ended before the closing multipart boundary")
+    except Exception:
+        target.discard()
+        raise
+    return target.multipart_filename, part_path
+
+def upload_path(job_id):
+    """Returns where the upload for a job is saved.
+
+    Parsing reads the PDF through a memory map, so a file a job may still be reading must never be
+    rewritten in place; truncating a mapped file kills the reading process with SIGBUS. Naming uploads
+    after their (unique) job id guarantees that, and keeps jobs for same-named files apart.
+    """
+    return os.path.join(UPLOAD_FOLDER, f"{job_id}.pdf")
 
 # -------------------
-# Final Output Generation
+# Background Jobs
 # -------------------
+REDIS_URL = os.environ.get('REDIS_URL')
+job_queue = Queue('pdf-parser', connection=Redis.from_url(REDIS_URL)) if REDIS_URL and Queue is not None else None
+# Without Redis, jobs run on a small in-process thread pool, which is enough for local use.
+local_executor = ThreadPoolExecutor(max_workers=2)
+# job_id -> (future, submitted_at); finished jobs are dropped after JOB_TTL seconds.
+local_jobs = {}
+# How long a finished job's result (and its output zip) stays available, for both backends.
+JOB_TTL = 60 * 60
+_JOB_ID_RE = re.compile(r'^[0-9a-f]{32}$')
 
-def generate_jsonl_outputs(toc, sections, metadata, base_filename, output_dir):
-    """Generates all required JSONL output files with the specified schema."""
-    output_paths = {}
-    doc_title = re.sub(r'[\-_]', ' ', base_filename).title()
-
-    def create_structured_entry(entry_data):
-        """Helper function to create the detailed JSON object per the new schema."""
-        section_id = entry_data['section_id']
-        title = entry_data.get('title', '')
-        
-        # Determine parent_id
-        parent_id = '.'.join(section_id.split('.')[:-1]) if '.' in section_id else None
-        
-        # Generate tags from the title
-        words = re.findall(r'\b[a-z]+\b', title.lower())
-        tags = sorted(list(set(word for word in words if word not in STOP_WORDS)))
-
-        return {
-            "doc_title": doc_title,
-            "section_id": section_id,
-            "title": title,
-            "page": entry_data.get('page'),
-            "level": entry_data.get('level'),
-            "parent_id": parent_id,
-            "full_path": f"{section_id} {title}",
-            "tags": tags
-        }
-
-    # 1. ToC JSONL
-    toc_path = os.path.join(output_dir, f"{base_filename}_toc.jsonl")
-    with open(toc_path, 'w', encoding='utf-8') as f:
-        for entry in toc:
-            structured_entry = create_structured_entry(entry)
-            f.write(json.dumps(structured_entry, ensure_ascii=False) + '\n')
-    output_paths['toc'] = toc_path
-
-    # 2. Sections (Spec) JSONL
-    spec_path = os.path.join(output_dir, f"{base_filename}_spec.jsonl")
-    with open(spec_path, 'w', encoding='utf-8') as f:
-        for section in sections:
-            structured_entry = create_structured_entry(section)
-            structured_entry['content'] = section.get('content', '') 
-            f.write(json.dumps(structured_entry, ensure_ascii=False) + '\n')
-    output_paths['spec'] = spec_path
-
-    # 3. Metadata JSONL
-    metadata_path = os.path.join(output_dir, f"{base_filename}_metadata.jsonl")
-    with open(metadata_path, 'w', encoding='utf-8') as f:
-        f.write(json.dumps(metadata, ensure_ascii=False) + '\n')
-    output_paths['metadata'] = metadata_path
-    
-    return output_paths
-
-def generate_validation_report(toc, sections, base_filename, output_dir):
-    """Generates an Excel validation report."""
-    report_path = os.path.join(output_dir, f"{base_filename}_validation_report.xlsx")
-    
-    try:
-        summary_df = pd.DataFrame({
-            "Metric": ["Total Entries in ToC", "Total Sections Parsed"],
-            "Count": [len(toc), len(sections)]
-        })
-
-        toc_map = {entry['section_id']: entry for entry in toc}
-        sections_map = {sec['section_id']: sec for sec in sections}
-        all_ids = sorted(list(set(toc_map.keys()) | set(sections_map.keys())))
-
-        validation_records = []
-        for section_id in all_ids:
-            record = { "section_id": section_id }
-            status = "OK"
-            notes = ""
-            
-            if section_id in toc_map and section_id in sections_map:
-                notes = "Section found in ToC and parsed."
-            elif section_id in toc_map:
-                status = "Mismatch / Not Parsed"
-                notes = "Section in ToC but not found in parsed output."
-            else: # in sections_map only
-                status = "Gap / Not in ToC"
-                notes = "Section parsed but does not exist in ToC."
-
-            record.update({
-                "toc_title": toc_map.get(section_id, {}).get('title', 'N/A'),
-                "toc_page": toc_map.get(section_id, {}).get('page', 'N/A'),
-                "status": status, "notes": notes
-            })
-            validation_records.append(record)
-        
-        detail_df = pd.DataFrame(validation_records)
-
-        with pd.ExcelWriter(report_path, engine='openpyxl') as writer:
-            summary_df.to_excel(writer, sheet_name='Validation', index=False, startrow=1)
-            detail_df.to_excel(writer, sheet_name='Validation', index=False, startrow=len(summary_df) + 4)
-        
-        return report_path
-    except Exception as e:
-        flash(f"Could not generate validation report: {e}", "error")
-        return None
+def new_job_id():
+    return uuid.uuid4().hex
+
+def job_output_dir(job_id):
+    return os.path.join(OUTPUT_FOLDER, job_id)
+
+def prune_expired_jobs():
+    """Forgets local jobs older than JOB_TTL and deletes output directories last written before that."""
+    expired = time.monotonic() - JOB_TTL
+    for job_id, (future, submitted_at) in list(local_jobs.items()):
+        if future.done() and submitted_at < expired:
+            local_jobs.pop(job_id, None)
+            shutil.rmtree(job_output_dir(job_id), ignore_errors=True)
+
+    # RQ expires its results after the same TTL, so its jobs' directories go the same way.
+    expired = time.time() - JOB_TTL
+    with os.scandir(OUTPUT_FOLDER) as it:
+        for entry in it:
+            if entry.is_dir() and _JOB_ID_RE.match(entry.name) and entry.stat().st_mtime < expired:
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+def enqueue_parse_job(job_id, pdf_path, filename, compression):
+    """Schedules parsing of a saved upload under the given job id."""
+    prune_expired_jobs()
+    args = (pdf_path, filename, job_output_dir(job_id), PARSE_CACHE_FOLDER, compression)
+    if job_queue is not None:
+        job_queue.enqueue(run_rq_parse_job, *args, job_id=job_id, job_timeout='10m',
+                          result_ttl=JOB_TTL, failure_ttl=JOB_TTL)
+        return
+    local_jobs[job_id] = (local_executor.submit(run_parse_job, *args), time.monotonic())
+
+def get_job_state(job_id):
+    """Returns (status, result) for a job; status is None for unknown ids and result is set once finished."""
+    if job_queue is not None:
+        try:
+            job = Job.fetch(job_id, connection=job_queue.connection)
+        except NoSuchJobError:
+            return None, None
+        status = job.get_status()
+        return status, job.return_value() if status == 'finished' else None
+
+    future, _ = local_jobs.get(job_id, (None, None))
+    if future is None:
+        return None, None
+    if not future.done():
+        return ('started' if future.running() else 'queued'), None
+    if future.exception() is not None:
+        current_app.logger.error("Parse job %s failed", job_id, exc_info=future.exception())
+        return 'failed', None
+    return 'finished', future.result()
 
 # -------------------
 # Flask Routes
 # -------------------
-@app.route('/')
+def requested_compression():
+    """Returns the ?compression= value, or None if it is not a known archive mode."""
+    compression = request.args.get('compression', 'stored')
+    return compression if compression in ZIP_COMPRESSION else None
+
+def accepted(job_id):
+    return jsonify(job_id=job_id, result_url=url_for('pdf_parser.job_result', job_id=job_id)), 202
+
+@bp.route('/')
 def index():
     return render_template('index.html')
 
-@app.route('/upload', methods=['POST'])
+@bp.route('/upload', methods=['POST'])
 def upload_file():
-    if 'pdf_file' not in request.files:
-        flash("No file part in the request.", "error")
-        return redirect(url_for('index'))
-    
-    file = request.files['pdf_file']
-    if file.filename == '' or not file.filename.lower().endswith('.pdf'):
-        flash("No PDF file selected.", "error")
-        return redirect(url_for('index'))
-
-    filename = file.filename
-    pdf_path = os.path.join(UPLOAD_FOLDER, filename)
-    file.save(pdf_path)
-
-    toc = parse_toc(pdf_path)
-    if not toc:
-        flash("Failed to parse the Table of Contents. Please check if the PDF has a machine-readable ToC.", "error")
-        return redirect(url_for('index'))
-    
-    sections = parse_sections(pdf_path, toc)
-    if not sections:
-        flash("Failed to extract content for the sections.", "error")
-        return redirect(url_for('index'))
-
-    base_filename = os.path.splitext(filename)[0]
-
-    with fitz.open(pdf_path) as doc:
-        metadata = {
-            "source_filename": filename,
-            "total_pages": len(doc),
-            "toc_entries_found": len(toc),
-            "sections_parsed": len(sections)
-        }
-    
-    output_files = generate_jsonl_outputs(toc, sections, metadata, base_filename, OUTPUT_FOLDER)
-    report_path = generate_validation_report(toc, sections, base_filename, OUTPUT_FOLDER)
-    if report_path:
-        output_files['report'] = report_path
-
-    zip_filename = f"{base_filename}_output.zip"
-    zip_path = os.path.join(OUTPUT_FOLDER, zip_filename)
-    
-    try:
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for key, path in output_files.items():
-                zipf.write(path, os.path.basename(path))
-    except Exception as e:
-        flash(f"Error creating zip file: {e}", "error")
-        return redirect(url_for('index'))
+    compression = requested_compression()
+    if compression is None:
+        return jsonify(errors=[f"Unknown compression '{request.args['compression']}'. Use one of: {', '.join(ZIP_COMPRESSION)}."]), 400
 
-    return send_from_directory(OUTPUT_FOLDER, zip_filename, as_attachment=True)
+    file = None
+    part_path = None
+    if StreamingFormDataParser is not None and request.mimetype == 'multipart/form-data':
+        try:
+            filename, part_path = stream_multipart_upload()
+        except ParseFailedException:
+            return jsonify(errors=["Malformed or incomplete multipart upload."]), 400
+    else:
+        file = request.files.get('pdf_file')
+        filename = file.filename if file else None
+
+    if filename is None or filename == '' or not filename.lower().endswith('.pdf'):
+        if part_path and os.path.exists(part_path):
+            os.remove(part_path)
+        if filename is None:
+            return jsonify(errors=["No file part in the request."]), 400
+        return jsonify(errors=["No PDF file selected."]), 400
+
+    filename = os.path.basename(filename)
+    job_id = new_job_id()
+    pdf_path = upload_path(job_id)
+    if part_path:
+        os.replace(part_path, pdf_path)
+    else:
+        file.save(pdf_path)
+
+    enqueue_parse_job(job_id, pdf_path, filename, compression)
+    return accepted(job_id)
+
+@bp.route('/upload_stream', methods=['POST'])
+def upload_stream():
+    """Accepts the PDF as the raw request body, e.g. `curl --data-binary @spec.pdf '/upload_stream?filename=spec.pdf'`."""
+    filename = os.path.basename(request.args.get('filename', ''))
+    if not filename.lower().endswith('.pdf'):
+        return jsonify(errors=["A 'filename' query parameter ending in .pdf is required."]), 400
+    compression = requested_compression()
+    if compression is None:
+        return jsonify(errors=[f"Unknown compression '{request.args['compression']}'. Use one of: {', '.join(ZIP_COMPRESSION)}."]), 400
+
+    job_id = new_job_id()
+    pdf_path = upload_path(job_id)
+    with open(pdf_path, 'wb') as f:
+        shutil.copyfileobj(request.stream, f, UPLOAD_CHUNK_SIZE)
+
+    enqueue_parse_job(job_id, pdf_path, filename, compression)
+    return accepted(job_id)
+
+@bp.route('/result/<job_id>')
+def job_result(job_id):
+    """Returns 202 while the job is pending, then the output zip (or the reason it failed)."""
+    status, result = get_job_state(job_id)
+    if status is None:
+        return jsonify(errors=["Unknown job id."]), 404
+    if status == 'finished':
+        if "error" in result:
+            return jsonify(errors=[result["error"]]), 422
+        return send_from_directory(job_output_dir(job_id), result["zip_filename"], as_attachment=True)
+    if status in ('failed', 'stopped', 'canceled'):
+        return jsonify(status=status, errors=["Processing failed unexpectedly."]), 500
+    return jsonify(status=status), 202
 
 # -------------------
 # Run Flask App
 # -------------------   
+app = create_app()
+
 if __name__ == '__main__':
     print("🚀 Starting Flask PDF Parser. Open http://127.0.0.1:5000 in your browser.")
-    app.run(debug=True)
\ No newline at end of file
+    # The debugger and reloader are for local development only; use gunicorn in production (see readme).
+    app.run(debug=os.environ.get('FLASK_ENV') == 'dev')
\ No newline at end of file
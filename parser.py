@@ -0,0 +1,525 @@
+#!/usr/bin/env python3
+"""PDF parsing pipeline: ToC and section extraction plus JSONL/Excel output generation.
+
+Kept free of Flask so RQ workers import only what they need. Page pool workers import this module
+too, but like any multiprocessing child they also re-import the launching script: under `python app.py`
+that is app.py, so there each worker loads Flask as well (gunicorn and `rq worker` avoid this).
+"""
+import os
+import re
+import hashlib
+import io
+import json
+import logging
+import fitz  # PyMuPDF
+import mmap
+import multiprocessing
+import pickle
+import threading
+import uuid
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import ExitStack, contextmanager
+from functools import lru_cache
+from itertools import chain, repeat
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# -------------------
+# Parser Settings
+# -------------------
+# Bump whenever parse_toc/parse_sections output changes so stale cache entries are ignored.
+PARSE_CACHE_VERSION = 4
+# PDFs shorter than this are extracted in-process; shipping pages to worker processes costs more than it saves.
+PARALLEL_MIN_PAGES = 32
+READ_CHUNK_SIZE = 1024 * 1024
+# Least recently used parse cache entries are deleted once the cache grows past this size.
+PARSE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+# Archive modes selectable with ?compression=...; JSONL is usually served locally, so skip deflate by default.
+ZIP_COMPRESSION = {
+    'stored': (zipfile.ZIP_STORED, None),
+    'deflate': (zipfile.ZIP_DEFLATED, 1),
+}
+
+# A set of common English "stop words" to filter out from tags.
+STOP_WORDS = {
+    'a', 'about', 'above', 'after', 'again', 'against', 'all', 'am', 'an', 'and', 'any', 'are', 'as', 'at',
+    'be', 'because', 'been', 'before', 'being', 'below', 'between', 'both', 'but', 'by', 'can', 'did', 'do',
+    'does', 'doing', 'down', 'during', 'each', 'few', 'for', 'from', 'further', 'had', 'has', 'have', 'having',
+    'he', 'her', 'here', 'hers', 'herself', 'him', 'himself', 'his', 'how', 'i', 'if', 'in', 'into', 'is', 'it',
+    'its', 'itself', 'just', 'me', 'more', 'most', 'my', 'myself', 'no', 'nor', 'not', 'now', 'of', 'off', 'on',
+    'once', 'only', 'or', 'other', 'our', 'ours', 'ourselves', 'out', 'over', 'own', 's', 'same', 'she', 'should',
+    'so', 'some', 'such', 't', 'than', 'that', 'the', 'their', 'theirs', 'them', 'themselves', 'then', 'there',
+
+    'these', 'they', 'this', 'those', 'through', 'to', 'too', 'under', 'until', 'up', 'very', 'was', 'we', 'were',
+    'what', 'when', 'where', 'which', 'while', 'who', 'whom', 'why', 'will', 'with', 'you', 'your', 'yours',
+    'yourself', 'yourselves'
+}
+
+# Example Regex: ^(\d+(.\d+)*)(\s+)([^\n.]+)(.+)\s+(\d+)$
+# Using a simpler, more robust regex for broader compatibility.
+_TOC_RE = re.compile(r'^(\d+(?:\.\d+)*)\s+(.*?)\s+(?:\.|\s)*\s*(\d+)$')
+_SECTION_ID_RE = re.compile(r'^\d+(?:\.\d+)*$')
+_OUTLINE_TITLE_RE = re.compile(r'^(\d+(?:\.\d+)*)\s+(.*)$')
+STOP_WORDS_BYTES = frozenset(word.encode('ascii') for word in STOP_WORDS)
+# Maps every byte except a-z to a space so a title can be tokenized with one translate() + split().
+_TAG_BYTES = bytes(c if 97 <= c <= 122 else 32 for c in range(256))
+
+# (in ToC, parsed) -> (status, notes) for each row of the validation report.
+VALIDATION_STATUS = {
+    (True, True): ("OK", "Section found in ToC and parsed."),
+    (True, False): ("Mismatch / Not Parsed", "Section in ToC but not found in parsed output."),
+    (False, True): ("Gap / Not in ToC", "Section parsed but does not exist in ToC."),
+}
+
+# -------------------
+# Core PDF Parsing Logic
+# -------------------
+class PDFProcessingError(Exception):
+    """Raised when an upload cannot be turned into output files; the message is shown to the user."""
+
+def parse_toc(doc):
+    """Parses the Table of Contents, preferring the PDF's embedded outline over scanning ToC pages."""
+    try:
+        toc_data = toc_from_outline(doc.get_toc(simple=True), doc.page_count)
+        if toc_data:
+            return toc_data
+        return toc_from_text(doc)
+    except Exception as e:
+        raise PDFProcessingError(f"Error parsing table of contents: {e}") from e
+
+def toc_from_outline(outline, max_pages):
+    """Builds ToC entries from PyMuPDF's [level, title, page] outline (bookmark) entries.
+
+    Section ids are taken from the numbers printed in the titles when most titles carry a number
+    whose depth matches the bookmark's level. Otherwise a stray leading number ("802.3 Compatibility")
+    is just part of the title, and ids are synthesized from each entry's position in the hierarchy.
+    """
+    toc_data = []
+    matches = [_outline_number(level, title) for level, title, _ in outline]
+    numbered = sum(match is not None for match in matches) * 2 > len(outline)
+    counters = []
+    for (level, title, page), match in zip(outline, matches):
+        counters = counters[:level] + [0] * (level - len(counters))
+        counters[level - 1] += 1
+        if not 1 <= page <= max_pages:
+            continue
+        if not numbered:
+            section_id = ".".join(map(str, counters))
+        elif match:
+            section_id, title = match.groups()
+        else:
+            continue # Front matter and appendices outside the document's own numbering
+        toc_data.append({
+            "section_id": section_id,
+            "title": title.strip().rstrip('.'),
+            "page": page,
+            "level": section_id.count(".") + 1
+        })
+    return toc_data
+
+def _outline_number(level, title):
+    """Matches a leading section number in an outline title, if its depth agrees with the bookmark level."""
+    match = _OUTLINE_TITLE_RE.match(title)
+    if match and match.group(1).count(".") + 1 == level:
+        return match
+    return None
+
+def toc_from_text(doc):
+    """Scans the first pages of the document for printed ToC lines."""
+    toc_data = []
+    max_pages = doc.page_count
+    for pno in range(min(40, max_pages)): # Search in the first 40 pages
+        # Blocks carry their type, so image blocks (block[6] == 1) can be dropped before splitting lines.
+        blocks = doc.load_page(pno).get_text("blocks")
+        lines = (line for block in blocks if block[6] == 0 for line in block[4].splitlines())
+        pending_id = None
+        for line in lines:
+            line = line.strip()
+            # PyMuPDF emits the section number on its own line, ahead of the title.
+            if pending_id is not None:
+                line = f"{pending_id} {line}"
+                pending_id = None
+            elif _SECTION_ID_RE.match(line):
+                pending_id = line
+                continue
+            match = _TOC_RE.match(line)
+            if match:
+                section_id, title, page_num = match.groups()
+                page_num = int(page_num)
+                if page_num > max_pages:
+                    continue
+                toc_data.append({
+                    "section_id": section_id.strip(),
+                    "title": title.strip().rstrip('.'),
+                    "page": page_num,
+                    "level": section_id.count(".") + 1
+                })
+    return toc_data
+
+@contextmanager
+def open_pdf(pdf_path):
+    """Opens a PDF from a read-only memory map of the file instead of reading it into memory.
+
+    All readers of the same file are then served from the OS page cache. The document keeps
+    pdf_path as its name so worker processes can open the file themselves. The file must not be
+    truncated or rewritten while it is open: touching a page past the new end raises SIGBUS.
+    """
+    with open(pdf_path, 'rb') as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        view = memoryview(mm)
+        try:
+            doc = fitz.open(pdf_path, stream=view, filetype='pdf')
+            try:
+                yield doc
+            finally:
+                doc.close()
+        finally:
+            # The map cannot be closed while a view of it is still exported.
+            view.release()
+
+def _extract_pages(pdf_path, page_indices):
+    """Worker: extracts the text of the given pages using its own document handle."""
+    with open_pdf(pdf_path) as doc:
+        return {p: doc.load_page(p).get_text("text") for p in page_indices}
+
+_page_pool = None
+_page_pool_pid = None
+_page_pool_lock = threading.Lock()
+
+def page_pool():
+    """Returns the process pool shared by every parse job in this process, creating it on first use.
+
+    One pool of cpu_count() workers keeps concurrent jobs from oversubscribing the host. Workers are
+    started from a forkserver (spawn where that is unavailable) rather than forked from the web
+    process, whose other threads may hold locks a forked child would then wait on forever. A pool
+    inherited through fork belongs to the parent and is never reused.
+    """
+    global _page_pool, _page_pool_pid
+    with _page_pool_lock:
+        if _page_pool is None or _page_pool_pid != os.getpid():
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('forkserver')
+                context.set_forkserver_preload([__name__])
+            else:
+                context = multiprocessing.get_context('spawn')
+            _page_pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 1, mp_context=context)
+            _page_pool_pid = os.getpid()
+        return _page_pool
+
+def _reset_page_pool(pool):
+    global _page_pool
+    with _page_pool_lock:
+        if _page_pool is pool:
+            _page_pool = None
+
+def shutdown_page_pool():
+    """Stops this process's page pool, if it started one; the next large PDF starts a fresh pool."""
+    global _page_pool
+    with _page_pool_lock:
+        pool, _page_pool = _page_pool, None
+        if pool is not None and _page_pool_pid == os.getpid():
+            pool.shutdown()
+
+def extract_page_texts(doc, page_numbers):
+    """Returns {page: text} for the given pages, spread across worker processes for large PDFs."""
+    page_numbers = sorted(page_numbers)
+    workers = os.cpu_count() or 1
+    if len(page_numbers) < PARALLEL_MIN_PAGES or workers < 2 or not doc.name:
+        return {p: doc.load_page(p).get_text("text") for p in page_numbers}
+
+    chunk_size = -(-len(page_numbers) // workers)
+    shards = [page_numbers[start:start + chunk_size] for start in range(0, len(page_numbers), chunk_size)]
+    page_texts = {}
+    pool = page_pool()
+    try:
+        for shard_texts in pool.map(_extract_pages, repeat(doc.name), shards):
+            page_texts.update(shard_texts)
+    except BrokenProcessPool:
+        # A worker died (e.g. killed by the OOM killer); the next job starts a fresh pool.
+        _reset_page_pool(pool)
+        raise
+    return page_texts
+
+def parse_sections(doc, toc):
+    """Extracts content for each section defined in the TOC."""
+    sections = []
+    try:
+        max_pages = len(doc)
+        page_ranges = []
+        for i, entry in enumerate(toc):
+            start_page = max(0, entry["page"] - 1)
+            
+            if i + 1 < len(toc):
+                end_page = min(max_pages, toc[i + 1]["page"] - 1)
+            else:
+                end_page = max_pages
+
+            if end_page <= start_page:
+                end_page = min(start_page + 1, max_pages)
+            page_ranges.append(range(start_page, end_page))
+
+        # Each page is read at most once, and pages outside every section (front matter) never are.
+        needed_pages = set()
+        for pages in page_ranges:
+            needed_pages.update(pages)
+        page_texts = extract_page_texts(doc, needed_pages)
+
+        for entry, pages in zip(toc, page_ranges):
+            # Pages are appended to one growing buffer rather than collected into a list and joined.
+            buf = io.StringIO()
+            for p in pages:
+                buf.write(page_texts[p])
+                buf.write("\n")
+            content = buf.getvalue().strip()
+            
+            section_entry = entry.copy()
+            section_entry["content"] = content
+            sections.append(section_entry)
+
+    except Exception as e:
+        raise PDFProcessingError(f"Error extracting sections: {e}") from e
+    return sections
+
+# -------------------
+# Final Output Generation
+# -------------------
+
+@lru_cache(maxsize=4096)
+def title_tags(title):
+    """Returns the sorted, de-duplicated tags for a title, without stop words or single letters."""
+    tokens = title.lower().encode('ascii', 'replace').translate(_TAG_BYTES).split()
+    return tuple(sorted(token.decode('ascii') for token in set(tokens) - STOP_WORDS_BYTES if len(token) > 1))
+
+def to_jsonl_line(obj):
+    """Serializes one JSONL record to UTF-8 bytes, newline included."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE)
+    return (json.dumps(obj, ensure_ascii=False) + '\n').encode('utf-8')
+
+def generate_jsonl_outputs(toc, sections, metadata, base_filename, zipf):
+    """Writes all required JSONL outputs, with the specified schema, straight into the output zip."""
+    doc_title = re.sub(r'[\-_]', ' ', base_filename).title()
+
+    def create_structured_entry(entry_data):
+        """Helper function to create the detailed JSON object per the new schema."""
+        section_id = entry_data['section_id']
+        title = entry_data.get('title', '')
+        
+        # Determine parent_id
+        parent_id = '.'.join(section_id.split('.')[:-1]) if '.' in section_id else None
+        
+        # Generate tags from the title
+        tags = list(title_tags(title))
+
+        return {
+            "doc_title": doc_title,
+            "section_id": section_id,
+            "title": title,
+            "page": entry_data.get('page'),
+            "level": entry_data.get('level'),
+            "parent_id": parent_id,
+            "full_path": f"{section_id} {title}",
+            "tags": tags
+        }
+
+    def entry_key(entry_data):
+        # Sections are ToC entries plus content; the id alone is not unique when a ToC repeats an id.
+        return entry_data['section_id'], entry_data.get('title', ''), entry_data.get('page')
+
+    # Built once and shared by the ToC and spec files.
+    structured_by_key = {entry_key(entry): create_structured_entry(entry) for entry in toc}
+
+    # 1. ToC JSONL
+    with zipf.open(f"{base_filename}_toc.jsonl", 'w') as f:
+        for entry in toc:
+            f.write(to_jsonl_line(structured_by_key[entry_key(entry)]))
+
+    # 2. Sections (Spec) JSONL
+    with zipf.open(f"{base_filename}_spec.jsonl", 'w') as f:
+        for section in sections:
+            structured_entry = structured_by_key.get(entry_key(section)) or create_structured_entry(section)
+            f.write(to_jsonl_line({**structured_entry, 'content': section.get('content', '')}))
+
+    # 3. Metadata JSONL
+    with zipf.open(f"{base_filename}_metadata.jsonl", 'w') as f:
+        f.write(to_jsonl_line(metadata))
+
+def generate_validation_report(toc, sections, base_filename, zipf):
+    """Generates an Excel validation report and adds it to the output zip; returns whether it was added."""
+    # Imported here so processes that never build a report don't pay for loading openpyxl.
+    from openpyxl import Workbook
+
+    try:
+        toc_map = {entry['section_id']: entry for entry in toc}
+        parsed_ids = {sec['section_id'] for sec in sections}
+        # ToC ids first, in reading order, then any ids that only appear in the parsed sections.
+        all_ids = dict.fromkeys(chain((entry['section_id'] for entry in toc), (sec['section_id'] for sec in sections)))
+
+        # Write-only mode streams rows to disk instead of building a cell grid in memory.
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet('Validation')
+        ws.append(())
+        ws.append(("Metric", "Count"))
+        ws.append(("Total Entries in ToC", len(toc)))
+        ws.append(("Total Sections Parsed", len(sections)))
+        ws.append(())
+        ws.append(())
+        ws.append(("section_id", "toc_title", "toc_page", "status", "notes"))
+        for section_id in all_ids:
+            toc_entry = toc_map.get(section_id, {})
+            status, notes = VALIDATION_STATUS[section_id in toc_map, section_id in parsed_ids]
+            ws.append((section_id, toc_entry.get('title', 'N/A'), toc_entry.get('page', 'N/A'), status, notes))
+        # openpyxl needs a seekable target, so the workbook is built in memory before being added.
+        report = io.BytesIO()
+        wb.save(report)
+        zipf.writestr(f"{base_filename}_validation_report.xlsx", report.getvalue())
+        
+        return True
+    except Exception as e:
+        # The report is optional; the JSONL outputs are still delivered without it.
+        logger.warning("Could not generate validation report: %s", e)
+        return False
+
+# -------------------
+# Pipeline
+# -------------------
+def file_digest(path):
+    """Returns a BLAKE2b hex digest of a file's contents, read in chunks."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def parse_cache_path(cache_dir, digest):
+    return os.path.join(cache_dir, f"v{PARSE_CACHE_VERSION}-{digest}.pkl")
+
+def load_cached_parse(cache_dir, digest):
+    """Returns a previously stored parse result for this content digest, or None."""
+    cache_path = parse_cache_path(cache_dir, digest)
+    try:
+        with open(cache_path, 'rb') as f:
+            parsed = pickle.load(f)
+        # The mtime marks the last use, so prune_parse_cache evicts the least recently used entries.
+        os.utime(cache_path)
+        return parsed
+    except Exception:
+        # A missing, truncated or stale entry is simply reparsed and overwritten.
+        return None
+
+def save_cached_parse(cache_dir, digest, parsed):
+    cache_path = parse_cache_path(cache_dir, digest)
+    tmp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(parsed, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+        prune_parse_cache(cache_dir)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def prune_parse_cache(cache_dir, max_bytes=PARSE_CACHE_MAX_BYTES):
+    """Deletes the least recently used cache entries (including stale versions) until the cache fits in max_bytes."""
+    entries = []
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            if entry.name.endswith('.pkl'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass # Already evicted by a concurrent job
+        total -= size
+
+def parse_pdf(pdf_path):
+    """Parses the ToC and section contents of a PDF into a dict."""
+    with ExitStack() as stack:
+        try:
+            doc = stack.enter_context(open_pdf(pdf_path))
+        except Exception as e:
+            raise PDFProcessingError(f"Error opening PDF: {e}") from e
+
+        toc = parse_toc(doc)
+        if not toc:
+            raise PDFProcessingError("Failed to parse the Table of Contents. Please check if the PDF has a machine-readable ToC.")
+
+        sections = parse_sections(doc, toc)
+        if not sections:
+            raise PDFProcessingError("Failed to extract content for the sections.")
+
+        return {"toc": toc, "sections": sections, "total_pages": len(doc)}
+
+def parse_and_zip(pdf_path, filename, output_dir, cache_dir, compression='stored'):
+    """Runs the full parsing pipeline on a saved PDF and returns the filename of the zip written to output_dir.
+
+    filename is the name the PDF was uploaded as; it names the outputs, not the file that is read.
+    """
+    # Identical uploads reuse the earlier parse, whatever they are named.
+    digest = file_digest(pdf_path)
+    parsed = load_cached_parse(cache_dir, digest)
+    if parsed is None:
+        parsed = parse_pdf(pdf_path)
+        save_cached_parse(cache_dir, digest, parsed)
+
+    toc = parsed["toc"]
+    sections = parsed["sections"]
+    metadata = {
+        "source_filename": filename,
+        "total_pages": parsed["total_pages"],
+        "toc_entries_found": len(toc),
+        "sections_parsed": len(sections)
+    }
+
+    base_filename = os.path.splitext(filename)[0]
+    zip_filename = f"{base_filename}_output.zip"
+    zip_path = os.path.join(output_dir, zip_filename)
+    
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+        compress_type, compresslevel = ZIP_COMPRESSION[compression]
+        with zipfile.ZipFile(zip_path, 'w', compress_type, compresslevel=compresslevel) as zipf:
+            generate_jsonl_outputs(toc, sections, metadata, base_filename, zipf)
+            generate_validation_report(toc, sections, base_filename, zipf)
+    except Exception as e:
+        raise PDFProcessingError(f"Error creating zip file: {e}") from e
+
+    return zip_filename
+
+def run_parse_job(pdf_path, filename, output_dir, cache_dir, compression):
+    """Background job entry point; returns {"zip_filename": ...} or {"error": ...} for /result to report.
+
+    The upload is deleted once the job ends; the parse cache already covers a re-upload of the same file.
+    """
+    try:
+        return {"zip_filename": parse_and_zip(pdf_path, filename, output_dir, cache_dir, compression)}
+    except PDFProcessingError as e:
+        return {"error": str(e)}
+    finally:
+        try:
+            os.remove(pdf_path)
+        except FileNotFoundError:
+            pass
+
+def run_rq_parse_job(*args):
+    """RQ entry point: runs run_parse_job, then stops the page pool.
+
+    RQ runs each job in a forked work horse that leaves with os._exit(), skipping the pool's own
+    cleanup; its workers would otherwise outlive the horse, each with PyMuPDF loaded.
+    """
+    try:
+        return run_parse_job(*args)
+    finally:
+        shutdown_page_pool()